@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+# Copyright 2015 Neverware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for justfishin."""
+
+import bz2
+import gzip
+import io
+import os
+import tarfile
+import queue
+import tempfile
+import unittest
+
+from contextlib import redirect_stdout
+from unittest import mock
+
+from justfishin import (MiB, apply_filters, bytes_to_mibibytes,
+                        choose_chunksize, extract_with_tarfile, is_gnu_tar,
+                        list_bucket_pages, loop, safe_extract,
+                        tar_command, transfer_config)
+
+
+class Tests(unittest.TestCase):
+    """Unit tests."""
+
+    @staticmethod
+    def mock_key(name, size=0):
+        """Mock S3 key as returned by list_objects_v2."""
+        return {'Key': name, 'Size': size}
+
+    def test_bytes_to_mibibytes(self):
+        """Test bytes_to_mibibytes."""
+        self.assertEqual(bytes_to_mibibytes(1048576), 1)
+        self.assertEqual(bytes_to_mibibytes(1048576 / 2), 0.5)
+
+    def test_list_bucket_pages(self):
+        """Test list_bucket_pages."""
+        keys = ['a', 'b/1', 'b/2', 'c/d/1', 'e']
+        class MockPaginator(object):
+            """Mock list_objects_v2 paginator."""
+            # pylint: disable=too-few-public-methods
+            @staticmethod
+            def paginate(Bucket, Prefix, Delimiter=None):
+                # pylint: disable=invalid-name,unused-argument
+                page = {'Contents': [], 'CommonPrefixes': []}
+                for key in keys:
+                    if not key.startswith(Prefix):
+                        continue
+                    rest = key[len(Prefix):]
+                    if Delimiter and Delimiter in rest:
+                        common = Prefix + rest.split(Delimiter)[0] + Delimiter
+                        if {'Prefix': common} not in page['CommonPrefixes']:
+                            page['CommonPrefixes'].append({'Prefix': common})
+                    else:
+                        page['Contents'].append(Tests.mock_key(key))
+                return [page]
+        class MockClient(object):
+            """Mock boto3 S3 client."""
+            # pylint: disable=too-few-public-methods
+            @staticmethod
+            def get_paginator(_name):
+                return MockPaginator()
+
+        def listed_keys(prefix):
+            pages = []
+            list_bucket_pages(MockClient(), 'bkt', prefix, pages.append)
+            return sorted(key['Key'] for page in pages for key in page)
+
+        self.assertEqual(listed_keys(''), keys)
+        self.assertEqual(listed_keys('b/'), ['b/1', 'b/2'])
+
+    @staticmethod
+    def run_loop(pages, answers, filters=(), late_pages=()):
+        """Run loop with the given listing pages and user answers.
+
+        pages: list of pages queued before the first prompt
+
+        late_pages: list of pages queued once loop blocks waiting for
+        the listing
+
+        answers: list of (answer, pages) pairs; the pages are queued
+        when the answer is given
+
+        Returns the prompts shown, the output and the download_key mock.
+
+        """
+        late_pages = list(late_pages)
+
+        class Listing(queue.Queue):
+            """Queue that delivers late_pages when loop blocks on it."""
+            def get(self, block=True, timeout=None):
+                if block and self.empty():
+                    for page in late_pages:
+                        self.put(page)
+                    late_pages.clear()
+                return super().get(block, timeout)
+
+        listing = Listing()
+        for page in pages:
+            listing.put(page)
+        prompts = []
+        answers = iter(answers)
+
+        def fake_input(prompt):
+            prompts.append(prompt)
+            answer, new_pages = next(answers)
+            for page in new_pages:
+                listing.put(page)
+            return answer
+
+        output = io.StringIO()
+        with mock.patch('justfishin.list_bucket_async',
+                        return_value=listing), \
+             mock.patch('justfishin.download_key') as download_key, \
+             mock.patch('builtins.input', side_effect=fake_input), \
+             redirect_stdout(output):
+            loop(None, 'bkt', list(filters))
+        return prompts, output.getvalue(), download_key
+
+    def test_loop_merges_pages(self):
+        """Test that loop filters pages that arrive between prompts."""
+        page1 = [Tests.mock_key('a-1'), Tests.mock_key('a-2')]
+        page2 = [Tests.mock_key('a-3'), Tests.mock_key('b-1')]
+        prompts, output, download_key = Tests.run_loop(
+            [page1], [('a', [page2, None]), ('3', []), ('', [])])
+        self.assertIn('[Bucket bkt, 2 items so far]', output)
+        self.assertIn('[Bucket bkt, 3 items]', output)
+        self.assertEqual(prompts[-1], 'download and untar? [Y/n] ')
+        download_key.assert_called_once_with(None, 'bkt',
+                                             Tests.mock_key('a-3'))
+
+    def test_loop_no_match_waits_for_listing(self):
+        """Test that a filter is checked against the full listing."""
+        page1 = [Tests.mock_key('a-1'), Tests.mock_key('a-2')]
+        page2 = [Tests.mock_key('z-1')]
+        _, output, download_key = Tests.run_loop(
+            [page1], [('z', [page2, None]), ('y', [])])
+        self.assertNotIn('no matches', output)
+        download_key.assert_called_once_with(None, 'bkt',
+                                             Tests.mock_key('z-1'))
+
+    def test_loop_download_after_listing(self):
+        """Test that a download is only offered for a complete listing."""
+        prompts, output, download_key = Tests.run_loop(
+            [[Tests.mock_key('a-1')]], [('n', [])], filters=['a'],
+            late_pages=[[Tests.mock_key('b-1')], None])
+        self.assertEqual(prompts, ['download and untar? [Y/n] '])
+        self.assertIn('waiting for listing...', output)
+        self.assertIn('[Bucket bkt, 1 items]', output)
+        download_key.assert_not_called()
+
+    def test_tar_command(self):
+        """Test is_gnu_tar and tar_command."""
+        self.assertFalse(is_gnu_tar(os.devnull))
+        command = tar_command('tar')
+        self.assertIn('--no-same-owner', command)
+        self.assertIn('--no-same-permissions', command)
+        self.assertEqual(command[-1], '-')
+
+    def test_choose_chunksize(self):
+        """Test choose_chunksize."""
+        self.assertEqual(choose_chunksize(0), 5 * MiB)
+        self.assertEqual(choose_chunksize(5 * MiB), 5 * MiB)
+        self.assertEqual(choose_chunksize(20 * MiB), 10 * MiB)
+        self.assertEqual(choose_chunksize(45 * MiB), 15 * MiB)
+        self.assertEqual(choose_chunksize(2000 * MiB), 16 * MiB)
+        self.assertEqual(choose_chunksize(100 * 1024 * MiB), 16 * MiB)
+
+    def test_transfer_config(self):
+        """Test transfer_config uses a thread per part."""
+        self.assertEqual(transfer_config(MiB).max_concurrency, 1)
+        for size in (9 * MiB, 12 * MiB, 19 * MiB):
+            self.assertEqual(transfer_config(size).max_concurrency, 2)
+        self.assertEqual(transfer_config(100 * MiB).max_concurrency, 7)
+        self.assertEqual(transfer_config(1024 * MiB).max_concurrency, 10)
+
+    def test_safe_extract(self):
+        """Test safe_extract."""
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for name, data in (('a/b', b'small'), ('a/c/d', b'x' * (MiB + 1))):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            info = tarfile.TarInfo('a/e')
+            info.type = tarfile.SYMTYPE
+            info.linkname = 'b'
+            tar.addfile(info)
+        with tempfile.TemporaryDirectory() as path:
+            archive.seek(0)
+            with tarfile.open(fileobj=archive, mode='r|') as tar:
+                safe_extract(tar, path)
+            with open(os.path.join(path, 'a', 'e'), 'rb') as in_file:
+                self.assertEqual(in_file.read(), b'small')
+            self.assertEqual(os.path.getsize(os.path.join(path, 'a/c/d')),
+                             MiB + 1)
+
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            tar.addfile(tarfile.TarInfo('../evil'), io.BytesIO())
+        archive.seek(0)
+        with tarfile.open(fileobj=archive, mode='r|') as tar:
+            with tempfile.TemporaryDirectory() as path:
+                self.assertRaises(Exception, safe_extract, tar, path)
+
+        with tempfile.TemporaryDirectory() as path:
+            archive = io.BytesIO()
+            with tarfile.open(fileobj=archive, mode='w') as tar:
+                info = tarfile.TarInfo('../{}bar/evil'.format(
+                    os.path.basename(path)))
+                tar.addfile(info, io.BytesIO())
+            archive.seek(0)
+            with tarfile.open(fileobj=archive, mode='r|') as tar:
+                self.assertRaises(Exception, safe_extract, tar, path)
+
+    def test_safe_extract_directory_attributes(self):
+        """Test that directory attributes are set after their contents."""
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            info = tarfile.TarInfo('ro')
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o555
+            info.mtime = 1000000000
+            tar.addfile(info)
+            for name, data in (('ro/small', b'small'),
+                               ('ro/large', b'x' * (MiB + 1))):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        with tempfile.TemporaryDirectory() as path:
+            archive.seek(0)
+            with tarfile.open(fileobj=archive, mode='r|') as tar:
+                safe_extract(tar, path)
+            dir_path = os.path.join(path, 'ro')
+            try:
+                stat = os.stat(dir_path)
+                self.assertEqual(stat.st_mode & 0o777, 0o555)
+                self.assertEqual(stat.st_mtime, 1000000000)
+                self.assertEqual(sorted(os.listdir(dir_path)),
+                                 ['large', 'small'])
+            finally:
+                os.chmod(dir_path, 0o755)
+
+    def test_safe_extract_file_attributes(self):
+        """Test that small and large files get the same attributes."""
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for name, data in (('small', b'small'),
+                               ('large', b'x' * (MiB + 1))):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0o640
+                info.mtime = 1000000000
+                tar.addfile(info, io.BytesIO(data))
+        with tempfile.TemporaryDirectory() as path:
+            archive.seek(0)
+            with tarfile.open(fileobj=archive, mode='r|') as tar:
+                safe_extract(tar, path)
+            for name in ('small', 'large'):
+                stat = os.stat(os.path.join(path, name))
+                self.assertEqual(stat.st_mode & 0o777, 0o640)
+                self.assertEqual(stat.st_mtime, 1000000000)
+
+    def test_safe_extract_directory_attribute_errors(self):
+        """Test that failing to set directory attributes is non-fatal."""
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            info = tarfile.TarInfo('.')
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+            info = tarfile.TarInfo('./f')
+            info.size = 1
+            tar.addfile(info, io.BytesIO(b'x'))
+        real_utime = os.utime
+
+        def utime(target, *args, **kwargs):
+            if os.path.isdir(target):
+                raise PermissionError('not the owner')
+            return real_utime(target, *args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as path:
+            archive.seek(0)
+            with tarfile.open(fileobj=archive, mode='r|') as tar, \
+                 mock.patch('os.utime', side_effect=utime):
+                safe_extract(tar, path)
+            self.assertTrue(os.path.exists(os.path.join(path, 'f')))
+
+            archive.seek(0)
+            with tarfile.open(fileobj=archive, mode='r|',
+                              errorlevel=2) as tar, \
+                 mock.patch('os.utime', side_effect=utime):
+                self.assertRaises(tarfile.ExtractError, safe_extract,
+                                  tar, path)
+
+    def test_safe_extract_duplicate_names(self):
+        """Test that safe_extract keeps the last entry for a name."""
+        smalls = [b'small %d' % i for i in range(200)]
+        for versions in (smalls + [b'x' * (MiB + 1)],
+                         smalls + [b'x' * (MiB + 1), b'last']):
+            archive = io.BytesIO()
+            with tarfile.open(fileobj=archive, mode='w') as tar:
+                for data in versions:
+                    info = tarfile.TarInfo('f')
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+            for _ in range(10):
+                with tempfile.TemporaryDirectory() as path:
+                    archive.seek(0)
+                    with tarfile.open(fileobj=archive, mode='r|') as tar:
+                        safe_extract(tar, path)
+                    with open(os.path.join(path, 'f'), 'rb') as in_file:
+                        self.assertEqual(in_file.read(), versions[-1])
+
+    def test_extract_with_tarfile_errors(self):
+        """Test that extract_with_tarfile reports the root cause."""
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            info = tarfile.TarInfo('../evil')
+            info.size = 4 * MiB
+            tar.addfile(info, io.BytesIO(os.urandom(info.size)))
+        data = bz2.compress(archive.getvalue())
+
+        def fetch(pipe):
+            pipe.write(data)
+
+        def fail_fetch(pipe):
+            pipe.write(data[:100])
+            raise ValueError('download failed')
+
+        with tempfile.TemporaryDirectory() as path:
+            cwd = os.getcwd()
+            os.chdir(path)
+            try:
+                with self.assertRaisesRegex(Exception, 'Path Traversal'):
+                    extract_with_tarfile(fetch)
+                with self.assertRaisesRegex(ValueError, 'download failed'):
+                    extract_with_tarfile(fail_fetch)
+            finally:
+                os.chdir(cwd)
+
+    def test_extract_with_tarfile_compression(self):
+        """Test that extract_with_tarfile detects the compression."""
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            info = tarfile.TarInfo('f')
+            info.size = 1
+            tar.addfile(info, io.BytesIO(b'x'))
+        for data in (archive.getvalue(), bz2.compress(archive.getvalue()),
+                     gzip.compress(archive.getvalue())):
+            with tempfile.TemporaryDirectory() as path:
+                cwd = os.getcwd()
+                os.chdir(path)
+                try:
+                    extract_with_tarfile(lambda pipe: pipe.write(data))
+                    with open('f', 'rb') as in_file:
+                        self.assertEqual(in_file.read(), b'x')
+                finally:
+                    os.chdir(cwd)
+
+    def test_apply_filters(self):
+        """Test apply_filters."""
+        inp = [Tests.mock_key('foo bar')]
+        self.assertEqual(list(apply_filters(inp, ['foo'])), inp)
+        self.assertEqual(list(apply_filters(inp, ['zoo'])), [])
+        self.assertEqual(apply_filters(inp, ['bar', 'foo']), inp)
+        self.assertEqual(apply_filters(inp, ['foo', 'zoo']), [])
+
+
+if __name__ == '__main__':
+    unittest.main()